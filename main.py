@@ -1,33 +1,32 @@
-import subprocess
 import sys
-import os
 
-mixer_script_path = os.path.join(os.path.dirname(__file__), "mixer_script.py")
-recommendation_script = os.path.join(os.path.dirname(__file__), "recommendation_script.py")
-shuffle_script = os.path.join(os.path.dirname(__file__), "shuffle_script.py")
+import mixer_script
+import recommendation_script
+import shuffle_script
 
-print("Running the mixer script")
-try:
-    subprocess.check_call([sys.executable, mixer_script_path])
-    print("Mixer script completed successfully\n")
-except subprocess.CalledProcessError as e:
-    print(f"An error occurred while running the mixer script: {e}")
-    sys.exit(1)
 
-print("Running the recommendation script")
-try:
-    subprocess.check_call([sys.executable, recommendation_script])
-    print("Recommendation script completed successfully\n")
-except subprocess.CalledProcessError as e:
-    print(f"An error occurred while running the recommendation script: {e}")
-    sys.exit(1)
+def run_stage(stage_name, run_stage_func, spotifyObject):
+    print(f"Running the {stage_name} script")
+    try:
+        run_stage_func(spotifyObject)
+    except SystemExit as e:
+        # The scripts use sys.exit for early termination; like the former
+        # subprocess dispatch, a zero exit code is not a pipeline error
+        if e.code:
+            print(f"An error occurred while running the {stage_name} script: exit code {e.code}")
+            sys.exit(e.code)
+    except Exception as e:
+        print(f"An error occurred while running the {stage_name} script: {e}")
+        sys.exit(1)
+    print(f"{stage_name.capitalize()} script completed successfully\n")
 
-print("Running the shuffle script")
-try:
-    subprocess.check_call([sys.executable, shuffle_script])
-    print("Shuffle script completed successfully\n")
-except subprocess.CalledProcessError as e:
-    print(f"An error occurred while running the shuffle script: {e}")
-    sys.exit(1)
+
+# Authenticate once and share the client across all three stages; the
+# recommendation scope is a superset of the scopes the other stages need.
+spotifyObject = recommendation_script.authenticate()
+
+run_stage("mixer", mixer_script.run, spotifyObject)
+run_stage("recommendation", recommendation_script.run, spotifyObject)
+run_stage("shuffle", shuffle_script.run, spotifyObject)
 
 print("All scripts completed successfully")
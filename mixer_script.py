@@ -1,12 +1,32 @@
 import os
 import sys
 import random
-import pip_system_certs.wrapt_requests  # Use this to fix SSL certificate issues
+import itertools
+import collections
+if os.environ.get("USE_SYSTEM_CERTS") == "1":
+    # Patches requests to use the system certificate store; walking the
+    # keychain takes noticeable time at import, so it is opt-in
+    import pip_system_certs.wrapt_requests  # noqa: F401
 import spotipy
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from spotipy.oauth2 import SpotifyOAuth
 from dotenv import load_dotenv
 
+try:
+    from pybloom_live import ScalableBloomFilter
+except ImportError:  # Optional; only needed to keep dedup memory flat on very large mixes
+    ScalableBloomFilter = None
+
+from spotify_utils import (
+    MAX_PARALLEL_REQUESTS,
+    add_tracks_to_playlist,
+    get_playlists_by_name,
+    get_user_id,
+    get_user_playlists,
+    retry_on_rate_limit,
+)
+
 # Load environment variables
 load_dotenv()
 
@@ -14,35 +34,31 @@ CLIENT_ID = os.getenv("SPOTIPY_CLIENT_ID")
 CLIENT_SECRET = os.getenv("SPOTIPY_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("SPOTIPY_REDIRECT_URI")
 
-# Authorization Flow Setup
-print("Authenticating with Spotify...")
-scope = "playlist-modify-public playlist-modify-private playlist-read-private playlist-read-collaborative"
-token = SpotifyOAuth(scope=scope, client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI)
-spotifyObject = spotipy.Spotify(auth_manager=token)
-print("Authentication successful.\n")
+# One explicit RNG instance; the module-global random state is not safe to
+# share now that fetches run on worker threads
+_rng = random.Random()
 
+# Opt-in aiohttp fetch path: one event loop fetches every page of every
+# source playlist at once instead of going playlist by playlist
+USE_ASYNC = os.getenv("SPOTIFY_MIXER_ASYNC") == "1"
+
+SCOPE = "playlist-modify-public playlist-modify-private playlist-read-private playlist-read-collaborative"
 
-def get_user_playlists(spotifyObject):
-    print("Fetching your playlists...")
-    playlists = []
-    limit = 50
-    offset = 0
-    with tqdm(desc="Playlists fetched", unit="playlist") as pbar:
-        while True:
-            results = spotifyObject.current_user_playlists(limit=limit, offset=offset)
-            playlists.extend(results["items"])
-            pbar.update(len(results["items"]))
-            if len(results["items"]) < limit:
-                break
-            offset += limit
-    print(f"Total playlists fetched: {len(playlists)}\n")
-    return playlists
+
+def authenticate(scope=SCOPE):
+    # Authorization Flow Setup
+    print("Authenticating with Spotify...")
+    token = SpotifyOAuth(scope=scope, client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI)
+    spotifyObject = spotipy.Spotify(auth_manager=token)
+    print("Authentication successful.\n")
+    return spotifyObject
 
 
 def get_playlist_by_name(playlists, names):
+    names = set(names)
     selected_playlists = [p for p in playlists if p["name"] in names]
     if selected_playlists:
-        playlist = random.choice(selected_playlists)
+        playlist = _rng.choice(selected_playlists)
         print(f"Randomly selected playlist: '{playlist['name']}'")
         return playlist
     else:
@@ -53,39 +69,61 @@ def get_playlist_tracks(spotifyObject, playlist_id, playlist_name):
     print(f"Fetching tracks from playlist '{playlist_name}'...")
     tracks = []
     limit = 100
-    offset = 0
-    total = spotifyObject.playlist(playlist_id)["tracks"]["total"]
+    fields = "items(track(id,artists(id))),total"
+    # The first page carries the total, sparing a full playlist() metadata call;
+    # the remaining page offsets are then known and fetched in parallel
+    first_page = retry_on_rate_limit(spotifyObject.playlist_items, playlist_id, limit=limit, offset=0, fields=fields)
+    total = first_page["total"]
+    pages = [first_page]
     with tqdm(total=total, desc=f"Tracks fetched from '{playlist_name}'", unit="track") as pbar:
-        while True:
-            results = spotifyObject.playlist_items(
-                playlist_id, limit=limit, offset=offset, fields="items(track(id,artists(id))),total"
-            )
-            items = results["items"]
-            for item in items:
+        if total > limit:
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS) as executor:
+                pages.extend(
+                    executor.map(
+                        lambda offset: retry_on_rate_limit(
+                            spotifyObject.playlist_items, playlist_id, limit=limit, offset=offset, fields=fields
+                        ),
+                        range(limit, total, limit),
+                    )
+                )
+        for results in pages:
+            for item in results["items"]:
                 track = item["track"]
                 if track:
                     track_id = track["id"]
                     artist_id = track["artists"][0]["id"] if track["artists"] else None
                     if track_id and artist_id:
                         tracks.append({"track_id": track_id, "artist_id": artist_id})
-                pbar.update(1)
-            if len(items) < limit:
-                break
-            offset += limit
+            # One progress update per page rather than per track
+            pbar.update(len(results["items"]))
     print(f"Total tracks fetched from '{playlist_name}': {len(tracks)}\n")
     return tracks
 
 
-def add_tracks_to_playlist(spotifyObject, playlist_id, track_ids):
-    print(f"Adding tracks to playlist '{playlist_id}'...")
-    limit = 100
-    total_batches = (len(track_ids) + limit - 1) // limit
-    with tqdm(total=len(track_ids), desc="Tracks added to playlist", unit="track") as pbar:
-        for i in range(0, len(track_ids), limit):
-            batch = track_ids[i : i + limit]
-            spotifyObject.playlist_add_items(playlist_id=playlist_id, items=batch)
-            pbar.update(len(batch))
-    print("Tracks successfully added to the playlist.\n")
+def get_playlist_tracks_async(spotifyObject, playlists):
+    """Fetch the tracks of all playlists through one aiohttp event loop."""
+    import spotify_async  # Imported lazily so aiohttp stays optional
+
+    print(f"Fetching tracks from {len(playlists)} playlists concurrently...")
+    fields = "items(track(id,artists(id))),total"
+    pages_per_playlist = spotify_async.fetch_playlist_pages(
+        spotifyObject, [playlist["id"] for playlist in playlists], fields
+    )
+    source_list = []
+    for playlist, pages in zip(playlists, pages_per_playlist):
+        tracks = []
+        for page in pages:
+            for item in page["items"]:
+                track = item["track"]
+                if track:
+                    track_id = track["id"]
+                    artist_id = track["artists"][0]["id"] if track["artists"] else None
+                    if track_id and artist_id:
+                        tracks.append({"track_id": track_id, "artist_id": artist_id})
+        print(f"Total tracks fetched from '{playlist['name']}': {len(tracks)}")
+        source_list.append(tracks)
+    print()
+    return source_list
 
 
 class Mixer(object):
@@ -98,75 +136,63 @@ class Mixer(object):
         self.source_list = source_list  # list of lists of dicts with 'track_id' and 'artist_id'
         self.dedup = dedup
         self.min_artist_separation = min_artist_separation
-        self.fail_fast = fail_fast
+        self.fail_fast = fail_fast  # implicit now: the single pass visits each candidate once
         self.max_tracks = max_tracks
 
-        self.track_history = set()
-        self.artist_history = []
-        self.cur_channel = 0  # index of current source
-        self.prepped = False
-
-        # We need to keep track of the position in each source
-        self.source_positions = [0 for _ in source_list]
+        if max_tracks > 10_000 and ScalableBloomFilter is not None:
+            # At this size a set of track IDs costs megabytes; a Bloom filter
+            # gives the same O(1) membership checks in ~1% of the memory
+            self.track_history = ScalableBloomFilter(initial_capacity=max_tracks, error_rate=0.001)
+        else:
+            self.track_history = set()
+        # Rolling window of recent artists: the deque evicts the oldest entry,
+        # the Counter gives O(1) membership checks for artist separation
+        self.artist_history = collections.deque(maxlen=min_artist_separation)
+        self.artist_history_counts = collections.Counter()
+
+        # Interleave the sources round-robin once upfront; next_track then just
+        # walks this sequence instead of cycling channels per call
+        self.candidates = self.interleave(source_list)
+        self.position = 0
+
+    @staticmethod
+    def interleave(source_list):
+        """Round-robin interleave the sources into a single candidate sequence."""
+        interleaved = []
+        for group in itertools.zip_longest(*source_list):
+            interleaved.extend(track for track in group if track is not None)
+        return interleaved
 
     def next_track(self):
-        self.prep()
-        consecutive_fails = 0
-        while len(self.source_list) > 0 and len(self.track_history) < self.max_tracks:
-            if self.fail_fast and consecutive_fails >= len(self.source_list):
-                return None
-            candidate_track = self.get_next_candidate()
-            if candidate_track is None:
-                # No more tracks in this source
-                consecutive_fails += 1
-                self.next_channel()
-            else:
-                good = self.good_candidate(candidate_track)
-                if good:
-                    self.add_to_history(candidate_track)
-                    self.next_channel()
-                    return candidate_track["track_id"]
-                else:
-                    consecutive_fails += 1
-                    self.next_channel()
+        while self.position < len(self.candidates) and len(self.track_history) < self.max_tracks:
+            candidate_track = self.candidates[self.position]
+            self.position += 1
+            if self.good_candidate(candidate_track):
+                self.add_to_history(candidate_track)
+                return candidate_track["track_id"]
         return None
 
     def add_to_history(self, track):
         self.track_history.add(track["track_id"])
         artist_id = track["artist_id"]
+        if self.artist_history.maxlen and len(self.artist_history) == self.artist_history.maxlen:
+            # The deque is about to evict its oldest entry on append
+            oldest = self.artist_history[0]
+            self.artist_history_counts[oldest] -= 1
+            if self.artist_history_counts[oldest] == 0:
+                del self.artist_history_counts[oldest]
         self.artist_history.append(artist_id)
-        # Limit the artist history to enforce min_artist_separation
-        if len(self.artist_history) > self.min_artist_separation:
-            self.artist_history = self.artist_history[-self.min_artist_separation :]
-
-    def next_channel(self):
-        self.cur_channel += 1
-        if self.cur_channel >= len(self.source_list):
-            self.cur_channel = 0
-
-    def get_next_candidate(self):
-        source = self.source_list[self.cur_channel]
-        position = self.source_positions[self.cur_channel]
-        if position >= len(source):
-            # No more tracks in this source
-            return None
-        track = source[position]
-        self.source_positions[self.cur_channel] += 1
-        return track
+        self.artist_history_counts[artist_id] += 1
 
     def good_candidate(self, track):
         if self.dedup and track["track_id"] in self.track_history:
             return False
         artist_id = track["artist_id"]
-        if artist_id in self.artist_history:
+        if artist_id in self.artist_history_counts:
             # Check artist separation
             return False
         return True
 
-    def prep(self):
-        if not self.prepped:
-            self.prepped = True
-
 
 def mix_tracks(source_list, dedup=True, min_artist_separation=4, fail_fast=True, max_tracks=1000):
     print("Mixing tracks using the Mixer algorithm...")
@@ -185,7 +211,7 @@ def mix_tracks(source_list, dedup=True, min_artist_separation=4, fail_fast=True,
     return mixed_tracks
 
 
-if __name__ == "__main__":
+def run(spotifyObject):
     # Playlist names
     daily_mix_1_3 = ["Daily Mix 1", "Daily Mix 2", "Daily Mix 3"]
     daily_mix_4_6 = ["Daily Mix 4", "Daily Mix 5", "Daily Mix 6"]
@@ -194,46 +220,43 @@ if __name__ == "__main__":
     # Get my playlists
     user_playlists = get_user_playlists(spotifyObject)
 
+    # Select the source playlists up front so the async path can fetch them all at once
+    selected_playlists = []
+
     # Randomly select one playlist from Daily Mix 1-3
     daily_mix_1_3_playlist = get_playlist_by_name(user_playlists, daily_mix_1_3)
     if daily_mix_1_3_playlist:
-        daily_mix_1_3_tracks = get_playlist_tracks(
-            spotifyObject, daily_mix_1_3_playlist["id"], daily_mix_1_3_playlist["name"]
-        )
-        random.shuffle(daily_mix_1_3_tracks)
+        selected_playlists.append(daily_mix_1_3_playlist)
     else:
-        daily_mix_1_3_tracks = []
         print("No Daily Mix 1-3 playlists found.\n")
 
     # Randomly select one playlist from Daily Mix 4-6
     daily_mix_4_6_playlist = get_playlist_by_name(user_playlists, daily_mix_4_6)
     if daily_mix_4_6_playlist:
-        daily_mix_4_6_tracks = get_playlist_tracks(
-            spotifyObject, daily_mix_4_6_playlist["id"], daily_mix_4_6_playlist["name"]
-        )
-        random.shuffle(daily_mix_4_6_tracks)
+        selected_playlists.append(daily_mix_4_6_playlist)
     else:
-        daily_mix_4_6_tracks = []
         print("No Daily Mix 4-6 playlists found.\n")
 
-    # Get tracks from other playlists
-    other_tracks_list = []
+    # Add the other playlists
     for playlist_name in other_playlists:
         playlist = get_playlist_by_name(user_playlists, [playlist_name])
         if playlist:
-            tracks = get_playlist_tracks(spotifyObject, playlist["id"], playlist_name)
-            random.shuffle(tracks)
-            other_tracks_list.append(tracks)
+            selected_playlists.append(playlist)
         else:
             print(f"Playlist '{playlist_name}' not found.\n")
 
-    # Combine all the shuffled tracks into source_list
-    source_list = []
-    if daily_mix_1_3_tracks:
-        source_list.append(daily_mix_1_3_tracks)
-    if daily_mix_4_6_tracks:
-        source_list.append(daily_mix_4_6_tracks)
-    source_list.extend(other_tracks_list)
+    # Fetch the tracks of every selected playlist
+    if USE_ASYNC:
+        source_list = get_playlist_tracks_async(spotifyObject, selected_playlists)
+    else:
+        source_list = [
+            get_playlist_tracks(spotifyObject, playlist["id"], playlist["name"]) for playlist in selected_playlists
+        ]
+
+    # Shuffle each source and drop the empty ones
+    for tracks in source_list:
+        _rng.shuffle(tracks)
+    source_list = [tracks for tracks in source_list if tracks]
     if not source_list:
         print("No tracks available to mix. Exiting program...")
         sys.exit()
@@ -249,13 +272,8 @@ if __name__ == "__main__":
     playlist_name = "[Mixer] Automated Radio Mix"
     playlist_description = "A mix of my favorite tracks from my Daily Mixes and other playlists."
 
-    existing_playlist = None
-    user_id = spotifyObject.current_user()["id"]
-    playlists = spotifyObject.current_user_playlists(limit=50)
-    for playlist in playlists["items"]:
-        if playlist["name"] == playlist_name:
-            existing_playlist = playlist
-            break
+    user_id = get_user_id(spotifyObject)
+    existing_playlist = get_playlists_by_name(spotifyObject).get(playlist_name)
 
     if existing_playlist:
         print(f"Updating existing playlist '{playlist_name}'...")
@@ -267,9 +285,16 @@ if __name__ == "__main__":
             user=user_id, name=playlist_name, public=False, description=playlist_description
         )
         playlist_id = new_playlist["id"]
+        # The cached playlist list is now stale; later stages must re-fetch it
+        get_user_playlists.cache_clear()
+        get_playlists_by_name.cache_clear()
         print(f"Playlist '{playlist_name}' created successfully.\n")
 
     add_tracks_to_playlist(spotifyObject, playlist_id, mixed_tracks)
 
     print(f"Mixed tracks successfully uploaded to playlist '{playlist_name}'.")
     print("Process completed.")
+
+
+if __name__ == "__main__":
+    run(authenticate())
@@ -1,12 +1,26 @@
 import os
 import sys
 import random
-import pip_system_certs.wrapt_requests  # Use this to fix SSL certificate issues
+import sqlite3
+if os.environ.get("USE_SYSTEM_CERTS") == "1":
+    # Patches requests to use the system certificate store; walking the
+    # keychain takes noticeable time at import, so it is opt-in
+    import pip_system_certs.wrapt_requests  # noqa: F401
 import spotipy
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from spotipy.oauth2 import SpotifyOAuth
 from dotenv import load_dotenv
 
+from spotify_utils import (
+    MAX_PARALLEL_REQUESTS,
+    add_tracks_to_playlist,
+    get_playlists_by_name,
+    get_user_id,
+    retry_on_rate_limit,
+)
+
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,23 +29,52 @@ CLIENT_ID = os.getenv("SPOTIPY_CLIENT_ID")
 CLIENT_SECRET = os.getenv("SPOTIPY_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("SPOTIPY_REDIRECT_URI")
 
-# Authorization Flow Setup
-print("Authenticating with Spotify...")
-scope = (
+# One explicit RNG instance; the module-global random state is not safe to
+# share now that fetches run on worker threads
+_rng = random.Random()
+
+SCOPE = (
     "playlist-modify-public playlist-modify-private playlist-read-private playlist-read-collaborative user-library-read"
 )
-token = SpotifyOAuth(scope=scope, client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI)
-spotifyObject = spotipy.Spotify(auth_manager=token)
-print("Authentication successful.\n")
+
+
+def authenticate(scope=SCOPE):
+    # Authorization Flow Setup
+    print("Authenticating with Spotify...")
+    token = SpotifyOAuth(scope=scope, client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI)
+    spotifyObject = spotipy.Spotify(auth_manager=token)
+    print("Authentication successful.\n")
+    return spotifyObject
+
+
+FEATURE_KEYS = ("instrumentalness", "energy", "danceability", "valence", "acousticness")
+
+CACHE_DB_PATH = os.path.expanduser("~/.cache/spotify_mixer/cache.db")
+
+
+def open_feature_cache():
+    """Open (creating if needed) the persistent per-track feature cache.
+
+    Audio features and popularity are immutable per track ID, so they are
+    cached across runs to skip API calls for tracks seen before.
+    """
+    os.makedirs(os.path.dirname(CACHE_DB_PATH), exist_ok=True)
+    connection = sqlite3.connect(CACHE_DB_PATH)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS features ("
+        "track_id TEXT PRIMARY KEY, instrumentalness REAL, energy REAL, "
+        "danceability REAL, valence REAL, acousticness REAL, popularity INTEGER)"
+    )
+    return connection
 
 
 def get_playlist_by_name(spotifyObject, playlist_name):
     print(f"Searching for playlist '{playlist_name}'...")
-    playlists = spotifyObject.current_user_playlists(limit=50)
-    for playlist in playlists["items"]:
-        if playlist["name"] == playlist_name:
-            print(f"Found playlist '{playlist_name}'.\n")
-            return playlist
+    # The full paginated list is cached, so this sees playlists beyond the first 50
+    playlist = get_playlists_by_name(spotifyObject).get(playlist_name)
+    if playlist:
+        print(f"Found playlist '{playlist_name}'.\n")
+        return playlist
     print(f"Playlist '{playlist_name}' not found.")
     sys.exit(1)
 
@@ -40,79 +83,102 @@ def get_playlist_tracks(spotifyObject, playlist_id, playlist_name):
     print(f"Fetching tracks from playlist '{playlist_name}'...")
     tracks = []
     limit = 100
-    offset = 0
-    total = spotifyObject.playlist(playlist_id)["tracks"]["total"]
+    fields = "items(track(id,popularity)),total"
+    # The first page carries the total, sparing a full playlist() metadata call;
+    # the remaining page offsets are then known and fetched in parallel
+    first_page = retry_on_rate_limit(spotifyObject.playlist_items, playlist_id, limit=limit, offset=0, fields=fields)
+    total = first_page["total"]
+    pages = [first_page]
     with tqdm(total=total, desc=f"Tracks fetched from '{playlist_name}'", unit="track") as pbar:
-        while True:
-            results = spotifyObject.playlist_items(playlist_id, limit=limit, offset=offset, fields="items(track(id))")
-            items = results["items"]
-            for item in items:
+        if total > limit:
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS) as executor:
+                pages.extend(
+                    executor.map(
+                        lambda offset: retry_on_rate_limit(
+                            spotifyObject.playlist_items, playlist_id, limit=limit, offset=offset, fields=fields
+                        ),
+                        range(limit, total, limit),
+                    )
+                )
+        for results in pages:
+            for item in results["items"]:
                 track = item["track"]
                 if track:
                     track_id = track["id"]
                     if track_id:
-                        tracks.append(track_id)
-                pbar.update(1)
-            if len(items) < limit:
-                break
-            offset += limit
+                        tracks.append({"id": track_id, "popularity": track["popularity"]})
+            # One progress update per page rather than per track
+            pbar.update(len(results["items"]))
     print(f"Total tracks fetched from '{playlist_name}': {len(tracks)}\n")
     return tracks
 
 
 def get_audio_features(spotifyObject, track_ids):
     print("Fetching audio features for tracks...")
-    audio_features = []
+    connection = open_feature_cache()
+
+    # Look up cached features first; only cache misses hit the API
+    features_by_id = {}
+    select_limit = 500
+    for i in range(0, len(track_ids), select_limit):
+        batch = track_ids[i : i + select_limit]
+        placeholders = ",".join("?" * len(batch))
+        rows = connection.execute(
+            f"SELECT track_id, instrumentalness, energy, danceability, valence, acousticness "
+            f"FROM features WHERE track_id IN ({placeholders})",
+            batch,
+        )
+        for row in rows:
+            features_by_id[row[0]] = dict(zip(("id",) + FEATURE_KEYS, row))
+    missing_ids = [track_id for track_id in track_ids if track_id not in features_by_id]
+
     limit = 100
+    batches = [missing_ids[i : i + limit] for i in range(0, len(missing_ids), limit)]
     with tqdm(total=len(track_ids), desc="Audio features fetched", unit="track") as pbar:
-        for i in range(0, len(track_ids), limit):
-            batch = track_ids[i : i + limit]
-            features = spotifyObject.audio_features(batch)
-            audio_features.extend(features)
-            pbar.update(len(batch))
+        pbar.update(len(track_ids) - len(missing_ids))
+        if batches:
+            # The batches are independent, so fetch them in parallel; executor.map
+            # yields results in order, and the SQLite writes stay on this thread
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS) as executor:
+                batch_results = executor.map(
+                    lambda batch: retry_on_rate_limit(spotifyObject.audio_features, batch), batches
+                )
+                for batch, features in zip(batches, batch_results):
+                    for feature in features:
+                        if feature:
+                            features_by_id[feature["id"]] = feature
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO features "
+                        "(track_id, instrumentalness, energy, danceability, valence, acousticness) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            (feature["id"],) + tuple(feature[key] for key in FEATURE_KEYS)
+                            for feature in features
+                            if feature
+                        ],
+                    )
+                    pbar.update(len(batch))
+    connection.commit()
+    connection.close()
+    audio_features = [features_by_id.get(track_id) for track_id in track_ids]
     print("Audio features fetched successfully.\n")
     return audio_features
 
 
-def calculate_average_criteria(audio_features):
+def calculate_average_criteria(audio_features, popularities):
     print("Calculating average criteria values...")
-    criteria = {
-        "instrumentalness": 0.0,
-        "energy": 0.0,
-        "danceability": 0.0,
-        "valence": 0.0,
-        "acousticness": 0.0,
-    }
-    popularity_total = 0
-    valid_features_count = 0
-
-    for features in audio_features:
-        if features is not None:
-            valid_features_count += 1
-            criteria["instrumentalness"] += features["instrumentalness"]
-            criteria["energy"] += features["energy"]
-            criteria["danceability"] += features["danceability"]
-            criteria["valence"] += features["valence"]
-            criteria["acousticness"] += features["acousticness"]
-            # Popularity is not part of audio features, need to fetch it separately
-        else:
-            print("Warning: Some tracks have no audio features.")
-
-    for key in criteria:
-        criteria[key] /= valid_features_count
-
-    # Fetch popularity separately
-    print("Fetching track popularity...")
-    popularity_total = 0
-    limit = 50
-    with tqdm(total=len(audio_features), desc="Popularity fetched", unit="track") as pbar:
-        for i in range(0, len(audio_features), limit):
-            batch_ids = [af["id"] for af in audio_features[i : i + limit] if af]
-            tracks = spotifyObject.tracks(batch_ids)
-            for track in tracks["tracks"]:
-                popularity_total += track["popularity"]
-                pbar.update(1)
-    average_popularity = popularity_total / valid_features_count
+    valid_features = [features for features in audio_features if features is not None]
+    if len(valid_features) < len(audio_features):
+        print("Warning: Some tracks have no audio features.")
+
+    # Column means over an (N, 5) float32 array instead of a per-track Python loop
+    feature_array = np.fromiter(
+        (features[key] for features in valid_features for key in FEATURE_KEYS), dtype=np.float32
+    ).reshape(-1, len(FEATURE_KEYS))
+    criteria = dict(zip(FEATURE_KEYS, feature_array.mean(axis=0).tolist()))
+
+    # Popularity comes along with the track fetch, so no extra API pass is needed
+    average_popularity = sum(popularities) / len(popularities)
     criteria["popularity"] = average_popularity / 100  # Normalize to 0-1 scale
 
     print("Average criteria values calculated:\n")
@@ -122,15 +188,12 @@ def calculate_average_criteria(audio_features):
     return criteria
 
 
-def get_seed_tracks_and_artists(track_ids):
+def get_seed_tracks_and_artists(spotifyObject, track_ids):
     print("Selecting seed tracks and artists...")
-    seed_tracks = random.sample(track_ids, min(len(track_ids), 5))
-    seed_artists = []
-    for track_id in seed_tracks:
-        track = spotifyObject.track(track_id)
-        artist_id = track["artists"][0]["id"]
-        seed_artists.append(artist_id)
-    seed_artists = list(set(seed_artists))[:5]  # Max 5 seed artists
+    seed_tracks = _rng.sample(track_ids, min(len(track_ids), 5))
+    # One batched tracks() call instead of one track() call per seed
+    tracks_resp = spotifyObject.tracks(seed_tracks)
+    seed_artists = list({t["artists"][0]["id"] for t in tracks_resp["tracks"] if t.get("artists")})[:5]  # Max 5 seed artists
     print(f"Selected {len(seed_tracks)} seed tracks and {len(seed_artists)} seed artists.\n")
     return seed_tracks, seed_artists
 
@@ -138,7 +201,8 @@ def get_seed_tracks_and_artists(track_ids):
 def generate_recommendations(spotifyObject, criteria, seed_tracks, seed_artists, original_track_ids, limit=1000):
     print("Generating recommendations based on criteria...")
     recommendations = []
-    fetched_tracks = set()
+    # Seeding with the original tracks makes this a single exclusion set
+    fetched_tracks = set(original_track_ids)
     max_limit_per_call = 100  # Maximum allowed by Spotify API per request
 
     # Prepare parameter ranges, ensuring min <= max
@@ -149,68 +213,49 @@ def generate_recommendations(spotifyObject, criteria, seed_tracks, seed_artists,
             min_value, max_value = max_value, min_value
         return min_value, max_value
 
-    min_inst, max_inst = prepare_range(criteria["instrumentalness"], 0.2, 0.0, 1.0)
-    min_energy, max_energy = prepare_range(criteria["energy"], 0.2, 0.0, 1.0)
-    min_dance, max_dance = prepare_range(criteria["danceability"], 0.2, 0.0, 1.0)
-    min_valence, max_valence = prepare_range(criteria["valence"], 0.2, 0.0, 1.0)
-    min_acoust, max_acoust = prepare_range(criteria["acousticness"], 0.2, 0.0, 1.0)
+    # Perturb a prepared range by a small random amount, keeping min <= max
+    def perturb_range(min_value, max_value, delta=0.05, min_allowed=0.0, max_allowed=1.0):
+        min_value = max(min_value + _rng.uniform(-delta, delta), min_allowed)
+        max_value = min(max_value + _rng.uniform(-delta, delta), max_allowed)
+        if min_value > max_value:
+            min_value, max_value = max_value, min_value
+        return min_value, max_value
+
+    feature_ranges = {key: prepare_range(criteria[key], 0.2, 0.0, 1.0) for key in FEATURE_KEYS}
 
     min_popularity = max(int(criteria["popularity"] * 100) - 20, 0)
     max_popularity = min(int(criteria["popularity"] * 100) + 20, 100)
     if min_popularity > max_popularity:
         min_popularity, max_popularity = max_popularity, min_popularity
 
-    # Prepare the list of seed combinations
-    seed_combinations = []
+    # Parameters that never change between calls, built once outside the loop
+    base_params = {"min_popularity": min_popularity, "max_popularity": max_popularity}
+
     seed_tracks = seed_tracks[:5]
     seed_artists = seed_artists[:5]
-    random.shuffle(seed_tracks)
-    random.shuffle(seed_artists)
-
-    # Limit the number of seed combinations to reduce API calls
-    for i in range(min(len(seed_tracks), 2)):
-        for j in range(min(len(seed_artists), 2)):
-            seed_combinations.append({"seed_tracks": seed_tracks[i : i + 3], "seed_artists": seed_artists[j : j + 2]})
-
-    # If no seed combinations, use tracks or artists alone
-    if not seed_combinations:
-        if seed_tracks:
-            seed_combinations = [{"seed_tracks": seed_tracks[:5]}]
-        elif seed_artists:
-            seed_combinations = [{"seed_artists": seed_artists[:5]}]
-        else:
-            print("No seed tracks or artists available for recommendations.")
-            return []
+    if not seed_tracks and not seed_artists:
+        print("No seed tracks or artists available for recommendations.")
+        return []
 
     total_requested = 0
-    combination_index = 0
-
-    original_track_ids_set = set(original_track_ids)
+    min_yield_rate = 0.1  # Stop when fewer than 10% of requested tracks are new
 
     with tqdm(total=limit, desc="Recommendations fetched", unit="track") as pbar:
         while len(recommendations) < limit and total_requested < 10000:
-            # Cycle through seed combinations
-            if combination_index >= len(seed_combinations):
-                combination_index = 0
-                random.shuffle(seed_combinations)
-            seeds = seed_combinations[combination_index]
-            combination_index += 1
-
-            params = {
-                "limit": min(max_limit_per_call, limit - len(recommendations)),
-                "min_instrumentalness": min_inst,
-                "max_instrumentalness": max_inst,
-                "min_energy": min_energy,
-                "max_energy": max_energy,
-                "min_danceability": min_dance,
-                "max_danceability": max_dance,
-                "min_valence": min_valence,
-                "max_valence": max_valence,
-                "min_acousticness": min_acoust,
-                "max_acousticness": max_acoust,
-                "min_popularity": min_popularity,
-                "max_popularity": max_popularity,
-            }
+            # Draw a fresh random seed sample each call; identical seeds tend to
+            # return overlapping tracks, so varying them boosts unique yield
+            seeds = {}
+            num_seed_tracks = _rng.randint(1, min(3, len(seed_tracks))) if seed_tracks else 0
+            if num_seed_tracks:
+                seeds["seed_tracks"] = _rng.sample(seed_tracks, num_seed_tracks)
+            num_seed_artists = min(len(seed_artists), 5 - num_seed_tracks)
+            if num_seed_artists:
+                seeds["seed_artists"] = _rng.sample(seed_artists, num_seed_artists)
+
+            params = {**base_params, "limit": min(max_limit_per_call, limit - len(recommendations))}
+            # Jitter the feature envelope slightly per call for the same reason
+            for key, (min_value, max_value) in feature_ranges.items():
+                params[f"min_{key}"], params[f"max_{key}"] = perturb_range(min_value, max_value)
             params.update(seeds)  # Add seed_tracks and/or seed_artists
 
             try:
@@ -218,7 +263,7 @@ def generate_recommendations(spotifyObject, criteria, seed_tracks, seed_artists,
                 for track in response["tracks"]:
                     track_id = track["id"]
                     # Exclude duplicates from original playlist and already fetched tracks
-                    if track_id not in fetched_tracks and track_id not in original_track_ids_set:
+                    if track_id not in fetched_tracks:
                         fetched_tracks.add(track_id)
                         recommendations.append(track_id)
                         pbar.update(1)
@@ -234,6 +279,11 @@ def generate_recommendations(spotifyObject, criteria, seed_tracks, seed_artists,
                 print("No more recommendations available with the current seeds and criteria.")
                 break
 
+            # Stop early once the seed envelope is clearly exhausted
+            if total_requested >= 500 and len(recommendations) / total_requested < min_yield_rate:
+                print("Recommendation yield dropped below 10%; stopping early.")
+                break
+
     print(f"Total unique recommendations fetched: {len(recommendations)}\n")
     return recommendations
 
@@ -243,41 +293,22 @@ def create_playlist_and_add_tracks(spotifyObject, track_ids, original_playlist_n
     playlist_description = f"An extended playlist based on '{original_playlist_name}' with similar songs."
     print(f"Creating new playlist '{playlist_name}'...")
     new_playlist = spotifyObject.user_playlist_create(
-        user=spotifyObject.current_user()["id"], name=playlist_name, public=False, description=playlist_description
+        user=get_user_id(spotifyObject), name=playlist_name, public=False, description=playlist_description
     )
     print(f"Playlist '{playlist_name}' created successfully.\n")
 
     # Add tracks to the new playlist
-    print(f"Adding tracks to playlist '{playlist_name}'...")
-    limit = 100
-    with tqdm(total=len(track_ids), desc="Tracks added to playlist", unit="track") as pbar:
-        for i in range(0, len(track_ids), limit):
-            batch = track_ids[i : i + limit]
-            spotifyObject.playlist_add_items(playlist_id=new_playlist["id"], items=batch)
-            pbar.update(len(batch))
-    print(f"Tracks successfully added to the playlist '{playlist_name}'.\n")
+    add_tracks_to_playlist(spotifyObject, new_playlist["id"], track_ids)
     return new_playlist["external_urls"]["spotify"]
 
 
-def add_tracks_to_playlist(spotifyObject, playlist_id, track_ids):
-    print(f"Adding tracks to playlist '{playlist_id}'...")
-    limit = 100
-    total_batches = (len(track_ids) + limit - 1) // limit
-    with tqdm(total=len(track_ids), desc="Tracks added to playlist", unit="track") as pbar:
-        for i in range(0, len(track_ids), limit):
-            batch = track_ids[i : i + limit]
-            spotifyObject.playlist_add_items(playlist_id=playlist_id, items=batch)
-            pbar.update(len(batch))
-    print("Tracks successfully added to the playlist.\n")
-
-
-# Main execution
-if __name__ == "__main__":
+def run(spotifyObject):
     original_playlist_name = "Liked Songs"
 
     # Fetch Liked Songs
     print("Fetching your Liked Songs playlist...")
     track_ids = []
+    popularities = []
     limit = 50
     offset = 0
     total = spotifyObject.current_user_saved_tracks(limit=1)["total"]
@@ -288,7 +319,9 @@ if __name__ == "__main__":
                 track = item["track"]
                 if track:
                     track_ids.append(track["id"])
-                pbar.update(1)
+                    popularities.append(track["popularity"])
+            # One progress update per page rather than per track
+            pbar.update(len(results["items"]))
             if len(results["items"]) < limit:
                 break
             offset += limit
@@ -299,10 +332,10 @@ if __name__ == "__main__":
 
     # Get audio features for tracks and calculate average criteria
     audio_features = get_audio_features(spotifyObject, track_ids)
-    criteria = calculate_average_criteria(audio_features)
+    criteria = calculate_average_criteria(audio_features, popularities)
 
     # Get seed tracks and artists
-    seed_tracks, seed_artists = get_seed_tracks_and_artists(track_ids)
+    seed_tracks, seed_artists = get_seed_tracks_and_artists(spotifyObject, track_ids)
 
     # Generate recommendations based on criteria
     limit = 50
@@ -313,15 +346,10 @@ if __name__ == "__main__":
 
     # Update the same playlist every day
     playlist_name = "[Mixer] Automated Radio Mix"
-    user_id = spotifyObject.current_user()["id"]
+    user_id = get_user_id(spotifyObject)
 
     # Fetch the existing playlist
-    existing_playlist = None
-    playlists = spotifyObject.current_user_playlists(limit=50)
-    for playlist in playlists["items"]:
-        if playlist["name"] == playlist_name:
-            existing_playlist = playlist
-            break
+    existing_playlist = get_playlists_by_name(spotifyObject).get(playlist_name)
 
     if existing_playlist:
         print(f"Adding new recommendations to existing playlist '{playlist_name}'...")
@@ -335,11 +363,15 @@ if __name__ == "__main__":
                 current_tracks.append(track["id"])
         # Filter out any recommendations that are already in the playlist
         new_tracks = [track for track in recommendations if track not in current_tracks]
-        # Add new recommendations to the playlist
-        add_tracks_to_playlist(spotifyObject, playlist_id, new_tracks)
+        # Add new recommendations after the mixed tracks already in the playlist
+        add_tracks_to_playlist(spotifyObject, playlist_id, new_tracks, starts_empty=False)
         print(f"New recommendations added to playlist '{playlist_name}'.\n")
     else:
         print(f"Playlist '{playlist_name}' not found. Exiting program...")
         sys.exit(1)
 
     print("Process completed.")
+
+
+if __name__ == "__main__":
+    run(authenticate())
@@ -1,11 +1,22 @@
 import sys
 import os
-import pip_system_certs.wrapt_requests  # Use this to fix SSL certificate issues
+if os.environ.get("USE_SYSTEM_CERTS") == "1":
+    # Patches requests to use the system certificate store; walking the
+    # keychain takes noticeable time at import, so it is opt-in
+    import pip_system_certs.wrapt_requests  # noqa: F401
 import spotipy
-from tqdm import tqdm
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from spotipy.oauth2 import SpotifyOAuth
 from dotenv import load_dotenv
-import random
+
+from spotify_utils import (
+    MAX_PARALLEL_REQUESTS,
+    add_tracks_to_playlist,
+    get_playlists_by_name,
+    get_user_id,
+    retry_on_rate_limit,
+)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,62 +25,72 @@ CLIENT_ID = os.getenv("SPOTIPY_CLIENT_ID")
 CLIENT_SECRET = os.getenv("SPOTIPY_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("SPOTIPY_REDIRECT_URI")
 
-# Authorization Flow Setup
-print("Authenticating with Spotify...")
-scope = "playlist-modify-public playlist-modify-private playlist-read-private playlist-read-collaborative"
-token = SpotifyOAuth(scope=scope, client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI)
-spotifyObject = spotipy.Spotify(auth_manager=token)
-print("Authentication successful.\n")
+# One explicit RNG instance; NumPy's shuffle is C-implemented and safe to keep
+# separate from any worker-thread use of the stdlib random module
+_rng = np.random.default_rng()
 
-if __name__ == "__main__":
+SCOPE = "playlist-modify-public playlist-modify-private playlist-read-private playlist-read-collaborative"
+
+
+def authenticate(scope=SCOPE):
+    # Authorization Flow Setup
+    print("Authenticating with Spotify...")
+    token = SpotifyOAuth(scope=scope, client_id=CLIENT_ID, client_secret=CLIENT_SECRET, redirect_uri=REDIRECT_URI)
+    spotifyObject = spotipy.Spotify(auth_manager=token)
+    print("Authentication successful.\n")
+    return spotifyObject
+
+
+def run(spotifyObject):
     playlist_name = "[Mixer] Automated Radio Mix"
-    user_id = spotifyObject.current_user()["id"]
+    user_id = get_user_id(spotifyObject)
 
     # Fetch the existing playlist
-    existing_playlist = None
-    playlists = spotifyObject.current_user_playlists(limit=50)
-    for playlist in playlists["items"]:
-        if playlist["name"] == playlist_name:
-            existing_playlist = playlist
-            break
+    existing_playlist = get_playlists_by_name(spotifyObject).get(playlist_name)
 
     if existing_playlist:
         print(f"Fetching tracks from playlist '{playlist_name}' for shuffling...")
         playlist_id = existing_playlist["id"]
         track_ids = []
-        offset = 0
         limit = 100
-        while True:
-            response = spotifyObject.playlist_items(
-                playlist_id, offset=offset, limit=limit, fields="items(track(id)),total"
-            )
-            items = response["items"]
-            for item in items:
+        fields = "items(track(id)),total"
+        # The first page reveals the total, then the remaining pages can be fetched in parallel
+        first_page = retry_on_rate_limit(spotifyObject.playlist_items, playlist_id, offset=0, limit=limit, fields=fields)
+        total = first_page["total"]
+        pages = [first_page]
+        if total > limit:
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS) as executor:
+                pages.extend(
+                    executor.map(
+                        lambda offset: retry_on_rate_limit(
+                            spotifyObject.playlist_items, playlist_id, offset=offset, limit=limit, fields=fields
+                        ),
+                        range(limit, total, limit),
+                    )
+                )
+        for response in pages:
+            for item in response["items"]:
                 track = item["track"]
                 if track:
                     track_ids.append(track["id"])
-            if len(items) < limit:
-                break
-            offset += limit
 
         # Shuffle the tracks
         print("Shuffling tracks...")
-        random.shuffle(track_ids)
+        track_ids = _rng.permutation(track_ids).tolist()
 
         # Replace the playlist with the shuffled tracks
         print("Updating playlist with shuffled tracks...")
         # First clear the playlist
         spotifyObject.playlist_replace_items(playlist_id, [])
         # Add shuffled tracks
-        limit = 100
-        with tqdm(total=len(track_ids), desc="Adding shuffled tracks", unit="track") as pbar:
-            for i in range(0, len(track_ids), limit):
-                batch = track_ids[i : i + limit]
-                spotifyObject.playlist_add_items(playlist_id, batch)
-                pbar.update(len(batch))
+        add_tracks_to_playlist(spotifyObject, playlist_id, track_ids)
         print(f"Playlist '{playlist_name}' updated with shuffled tracks.")
     else:
         print(f"Playlist '{playlist_name}' not found. Exiting program...")
         sys.exit(1)
 
     print("All scripts executed successfully.")
+
+
+if __name__ == "__main__":
+    run(authenticate())
@@ -0,0 +1,55 @@
+import asyncio
+
+import aiohttp
+
+API_BASE = "https://api.spotify.com/v1"
+MAX_CONCURRENT_REQUESTS = 5  # Parallel in-flight requests, matching the thread-pool cap
+PAGE_LIMIT = 100
+
+
+def _auth_headers(spotifyObject):
+    # Reuse the bearer token spotipy already obtained
+    token = spotifyObject.auth_manager.get_access_token(as_dict=False)
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def _get_json(session, semaphore, url, params):
+    while True:
+        async with semaphore:
+            async with session.get(url, params=params) as response:
+                if response.status != 429:
+                    response.raise_for_status()
+                    return await response.json()
+                retry_after = int(response.headers.get("Retry-After", 1))
+        # Sleep outside the semaphore so other requests can proceed
+        await asyncio.sleep(retry_after)
+
+
+async def _get_playlist_pages(session, semaphore, playlist_id, fields):
+    url = f"{API_BASE}/playlists/{playlist_id}/tracks"
+    first_page = await _get_json(session, semaphore, url, {"limit": PAGE_LIMIT, "offset": 0, "fields": fields})
+    remaining = await asyncio.gather(
+        *(
+            _get_json(session, semaphore, url, {"limit": PAGE_LIMIT, "offset": offset, "fields": fields})
+            for offset in range(PAGE_LIMIT, first_page["total"], PAGE_LIMIT)
+        )
+    )
+    return [first_page] + list(remaining)
+
+
+async def _fetch_all(spotifyObject, playlist_ids, fields):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with aiohttp.ClientSession(headers=_auth_headers(spotifyObject)) as session:
+        return await asyncio.gather(
+            *(_get_playlist_pages(session, semaphore, playlist_id, fields) for playlist_id in playlist_ids)
+        )
+
+
+def fetch_playlist_pages(spotifyObject, playlist_ids, fields):
+    """Fetch every page of every playlist concurrently.
+
+    One event loop orchestrates all requests across all playlists at once,
+    so the whole fetch phase takes about as long as its slowest page.
+    Returns a list of page lists, one per playlist, in the input order.
+    """
+    return asyncio.run(_fetch_all(spotifyObject, playlist_ids, fields))
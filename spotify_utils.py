@@ -0,0 +1,103 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import spotipy
+from tqdm import tqdm
+
+MAX_PARALLEL_REQUESTS = 5  # Parallel API requests, kept low to stay under Spotify's rolling rate limit
+
+
+def retry_on_rate_limit(func, *args, **kwargs):
+    """Call a Spotify API function, sleeping out 429 rate-limit responses."""
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except spotipy.exceptions.SpotifyException as e:
+            if e.http_status == 429:
+                retry_after = int(e.headers.get("Retry-After", 1)) if e.headers else 1
+                time.sleep(retry_after)
+            else:
+                raise
+
+
+def _add_batch_at_position(spotifyObject, playlist_id, batch, position):
+    """Insert one batch of tracks at its playlist offset.
+
+    Concurrent inserts can land before the batches ahead of them, in which
+    case the API rejects the position as out of bounds; wait briefly and
+    retry until the preceding batches have landed. Other 400s (e.g. an
+    invalid track URI) are raised immediately.
+    """
+    attempts_left = 150  # ~30 s of waiting on the preceding batches
+    while True:
+        try:
+            return retry_on_rate_limit(
+                spotifyObject.playlist_add_items, playlist_id=playlist_id, items=batch, position=position
+            )
+        except spotipy.exceptions.SpotifyException as e:
+            attempts_left -= 1
+            if e.http_status != 400 or "out of bounds" not in str(e).lower() or attempts_left <= 0:
+                raise
+            time.sleep(0.2)
+
+
+def add_tracks_to_playlist(spotifyObject, playlist_id, track_ids, starts_empty=True):
+    """Add tracks in concurrent 100-track batches, preserving input order.
+
+    starts_empty says the playlist is known to be empty (newly created or
+    just cleared); pass False to append after the tracks the playlist
+    already holds instead of interleaving with them from position 0.
+    """
+    print(f"Adding tracks to playlist '{playlist_id}'...")
+    limit = 100
+    base = 0
+    if not starts_empty:
+        base = retry_on_rate_limit(spotifyObject.playlist_items, playlist_id, limit=1, fields="total")["total"]
+    batches = [(base + offset, track_ids[offset : offset + limit]) for offset in range(0, len(track_ids), limit)]
+    with tqdm(total=len(track_ids), desc="Tracks added to playlist", unit="track") as pbar:
+        # Explicit positions preserve the intended order even when concurrent
+        # batches complete out of order
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS) as executor:
+            futures = [
+                executor.submit(_add_batch_at_position, spotifyObject, playlist_id, batch, offset)
+                for offset, batch in batches
+            ]
+            for future, (offset, batch) in zip(futures, batches):
+                future.result()
+                pbar.update(len(batch))
+    print("Tracks successfully added to the playlist.\n")
+
+
+@lru_cache(maxsize=None)
+def get_user_id(spotifyObject):
+    """Return the current user's ID, fetching it at most once per client."""
+    return spotifyObject.current_user()["id"]
+
+
+@lru_cache(maxsize=None)
+def get_user_playlists(spotifyObject):
+    """Fetch the full paginated playlist list, at most once per client.
+
+    The list never changes within a run, so all stages share one fetch.
+    """
+    print("Fetching your playlists...")
+    playlists = []
+    limit = 50
+    offset = 0
+    with tqdm(desc="Playlists fetched", unit="playlist") as pbar:
+        while True:
+            results = spotifyObject.current_user_playlists(limit=limit, offset=offset)
+            playlists.extend(results["items"])
+            pbar.update(len(results["items"]))
+            if len(results["items"]) < limit:
+                break
+            offset += limit
+    print(f"Total playlists fetched: {len(playlists)}\n")
+    return playlists
+
+
+@lru_cache(maxsize=None)
+def get_playlists_by_name(spotifyObject):
+    """Index the cached playlist list by name for O(1) lookups."""
+    return {playlist["name"]: playlist for playlist in get_user_playlists(spotifyObject)}